@@ -5,13 +5,41 @@ from itertools import groupby
 from pathlib import Path
 from typing import List, Optional, Union
 
-from jinja2 import Environment, FileSystemLoader, StrictUndefined
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    StrictUndefined,
+)
 from pydantic import BaseModel, validator, Extra
 from sqlalchemy import MetaData, Table
 from sqlalchemy.sql import sqltypes, text
 
 from ..core.errors import DBError, Exc, Ok
 
+try:
+    _bytecode_cache = FileSystemBytecodeCache()
+except RuntimeError:
+    # No safe temporary directory available, so templates are compiled on each run
+    _bytecode_cache = None
+
+# SQL templates are shipped with the package so there's no need to check for changes
+# on disk. All connections share these environments so templates are only compiled once
+_jinja_env = Environment(
+    loader=FileSystemLoader(Path(__file__).parent / "templates"),
+    undefined=StrictUndefined,
+    keep_trailing_newline=True,
+    auto_reload=False,
+    bytecode_cache=_bytecode_cache,
+)
+_jinja_test = Environment(
+    loader=FileSystemLoader(Path(__file__).parent.parent / "tasks/tests"),
+    undefined=StrictUndefined,
+    keep_trailing_newline=True,
+    auto_reload=False,
+    bytecode_cache=_bytecode_cache,
+)
+
 
 class Hook(BaseModel):
     sql: str
@@ -130,16 +158,8 @@ class Database:
         self._settings = settings
         self._requested_objects = dict()
 
-        self._jinja_env = Environment(
-            loader=FileSystemLoader(Path(__file__).parent / "templates"),
-            undefined=StrictUndefined,
-            keep_trailing_newline=True,
-        )
-        self._jinja_test = Environment(
-            loader=FileSystemLoader(Path(__file__).parent.parent / "tasks/tests"),
-            undefined=StrictUndefined,
-            keep_trailing_newline=True,
-        )
+        self._jinja_env = _jinja_env
+        self._jinja_test = _jinja_test
 
     def _obj_str(
         self, database: Optional[str], schema: Optional[str], table: str
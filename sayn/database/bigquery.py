@@ -1,10 +1,8 @@
-from copy import deepcopy
-from collections import Counter
-import csv
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import decimal
-from itertools import groupby
-import io
+import gzip
+import tempfile
 from typing import List, Optional, Union
 from uuid import UUID
 
@@ -13,12 +11,37 @@ from pydantic import validator, Extra, BaseModel
 from sqlalchemy import create_engine
 from sqlalchemy.sql import sqltypes
 
-from . import Database, Columns, Hook, BaseDDL
+from . import Database, Columns, Hook, BaseDDL, _jinja_env, _jinja_test
 
 from ..core.errors import DBError, Ok
 
 db_parameters = ["project", "credentials_path", "location", "dataset"]
 
+# BigQuery rejects gzip compressed JSON files larger than 4GB
+MAX_GZIP_LOAD_BYTES = 4 << 30
+
+python_types = {
+    int: sqltypes.Integer,
+    str: sqltypes.String,
+    float: sqltypes.Float,
+    decimal.Decimal: sqltypes.Numeric,
+    datetime.datetime: sqltypes.TIMESTAMP,
+    bytes: sqltypes.LargeBinary,
+    bool: sqltypes.Boolean,
+    datetime.date: sqltypes.Date,
+    datetime.time: sqltypes.Time,
+    datetime.timedelta: sqltypes.Interval,
+    list: sqltypes.ARRAY,
+    dict: sqltypes.JSON,
+    UUID: sqltypes.String,
+}
+
+# Max number of dataset introspection queries running at the same time
+MAX_INTROSPECTION_WORKERS = 8
+
+# Max number of load jobs submitted by load_data without waiting for their result
+MAX_PENDING_LOAD_JOBS = 8
+
 
 class DDL(BaseDDL):
     class Properties(BaseModel):
@@ -44,7 +67,14 @@ class DDL(BaseDDL):
 
     @validator("columns")
     def columns_unique(cls, v):
-        dupes = {k for k, v in Counter([e.name for e in v]).items() if v > 1}
+        seen = set()
+        dupes = set()
+        for e in v:
+            if e.name in seen:
+                dupes.add(e.name)
+            else:
+                seen.add(e.name)
+
         if len(dupes) > 0:
             raise ValueError(f"Duplicate columns: {','.join(dupes)}")
         else:
@@ -53,8 +83,9 @@ class DDL(BaseDDL):
     @validator("properties")
     def validate_properties(cls, v, values):
         if v is not None and v.cluster is not None:
-            if len(values.get("columns")) > 0:
-                missing_columns = set(v) - set([c.name for c in values.get("columns")])
+            if values.get("columns"):
+                col_names = {c.name for c in values["columns"]}
+                missing_columns = set(v.cluster) - col_names
                 if len(missing_columns) > 0:
                     raise ValueError(
                         f'Cluster contains columns not specified in the ddl: "{missing_columns}"'
@@ -84,6 +115,26 @@ class Bigquery(Database):
     dataset = None
     client = None
 
+    # google.cloud.bigquery, imported by create_engine as it's slow to import and
+    # sayn loads this module even when no BigQuery database is used
+    _bigquery = None
+
+    # pyarrow, imported on first use for the same reason. False if it's not installed
+    _pyarrow = None
+
+    # Templates are compiled at import and reused by every call
+    _TMPL_CREATE_TABLE = _jinja_env.get_template("create_table.sql")
+    _TMPL_STANDARD_TESTS = _jinja_test.get_template("standard_tests_bigquery.sql")
+    _TMPL_STANDARD_TEST_OUTPUT = _jinja_test.get_template(
+        "standard_test_output_bigquery.sql"
+    )
+
+    # Batches with more rows than this are loaded as parquet if pyarrow is installed
+    _PARQUET_THRESHOLD = 100000
+
+    # Set by load_data when its batches can be loaded as parquet
+    _parquet_batches = False
+
     def feature(self, feature):
         return feature in (
             "CAN REPLACE TABLE",
@@ -92,7 +143,7 @@ class Bigquery(Database):
         )
 
     def create_engine(self, settings):
-        settings = deepcopy(settings)
+        settings = {**settings}
         self.project = settings.pop("project")
 
         url = f"bigquery://{self.project}"
@@ -103,11 +154,48 @@ class Bigquery(Database):
         engine = create_engine(url, **settings)
         self.client = engine.raw_connection()._client
 
+        if Bigquery._bigquery is None:
+            from google.cloud import bigquery
+
+            Bigquery._bigquery = bigquery
+        bigquery = self._bigquery
+
+        # The type mapping is fixed, so compile it for the dialect only once
+        self._py2sqa_cache = dict()
+        for python_type, sqltype in python_types.items():
+            try:
+                self._py2sqa_cache[python_type] = sqltype().compile(
+                    dialect=engine.dialect
+                )
+            except Exception:
+                # Types that need arguments (eg: ARRAY) or that the dialect can't
+                # render are reported as not supported by _py2sqa
+                pass
+
+        self._pending_load_jobs = list()
+
+        # Load job configurations don't change between batches. The client copies
+        # them before making any changes so they're safe to share. Load jobs have no
+        # compression setting as BigQuery detects gzip compressed files itself
+        self._json_load_job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        )
+        self._parquet_load_job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+        )
+
+        # Features are static for BigQuery so we only evaluate them once
+        self._can_replace_table = self.feature("CAN REPLACE TABLE")
+        self._needs_cascade = self.feature("NEEDS CASCADE")
+        self._cannot_specify_ddl_select = self.feature("CANNOT SPECIFY DDL IN SELECT")
+
         return engine
 
+    # The base test methods load templates with get_template, which returns an already
+    # compiled Template as it is
     def _construct_tests(self, columns, table, schema=None):
         count_tests, query, breakdown = self._construct_tests_template(
-            columns, table, "standard_tests_bigquery.sql", schema
+            columns, table, self._TMPL_STANDARD_TESTS, schema
         )
         if count_tests == 0:
             return Ok([None, breakdown])
@@ -116,7 +204,7 @@ class Bigquery(Database):
 
     def test_problematic_values(self, failed: list, table: str, schema: str) -> str:
         return self.test_problematic_values_template(
-            failed, table, schema, "standard_test_output_bigquery.sql"
+            failed, table, schema, self._TMPL_STANDARD_TEST_OUTPUT
         )
 
     def _introspect(self, objects_to_introspect):
@@ -140,6 +228,9 @@ class Bigquery(Database):
             or project.project_id == self.project
         }
 
+        datasets = list()
+        queries = list()
+        objects_list = list()
         for project_id in objects.keys():
             project = objects[project_id]
 
@@ -163,7 +254,14 @@ class Bigquery(Database):
             }
 
             for dataset_id in project["datasets"].keys():
-                dataset = project["datasets"][dataset_id]
+                requested_objects = objects_to_introspect[
+                    get_project_key(project_id)
+                ].get(get_dataset_key(dataset_id))
+                if not requested_objects:
+                    continue
+
+                # Object names are passed as a query parameter so that the query
+                # text is the same on every run for a given dataset
                 query = f"""SELECT t.table_name
                                  , t.table_type
                                  , array_agg(STRUCT(c.column_name, c.is_partitioning_column = 'YES' AS is_partition, c.clustering_ordinal_position)
@@ -171,14 +269,32 @@ class Bigquery(Database):
                               FROM `{project_id}`.{dataset_id}.INFORMATION_SCHEMA.TABLES t
                               JOIN `{project_id}`.{dataset_id}.INFORMATION_SCHEMA.COLUMNS c
                                 ON c.table_name = t.table_name
+                             WHERE t.table_name IN UNNEST(@objects)
                              GROUP BY 1,2
                             """
-
-                result = self.read_data(query)
-
-                dataset["objects"] = {
-                    table["table_name"]: self._get_table_type(table) for table in result
-                }
+                datasets.append(project["datasets"][dataset_id])
+                queries.append(query)
+                objects_list.append(sorted(requested_objects))
+
+        # Each query is a round-trip to BigQuery, so when there's more than one
+        # dataset we run them concurrently
+        if len(queries) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(len(queries), MAX_INTROSPECTION_WORKERS)
+            ) as executor:
+                results = list(
+                    executor.map(self._read_introspection, queries, objects_list)
+                )
+        else:
+            results = [
+                self._read_introspection(query, objects)
+                for query, objects in zip(queries, objects_list)
+            ]
+
+        for dataset, result in zip(datasets, results):
+            dataset["objects"] = {
+                table["table_name"]: self._get_table_type(table) for table in result
+            }
 
         self._requested_objects = {
             get_project_key(project): {
@@ -188,67 +304,187 @@ class Bigquery(Database):
             for project, project_details in objects.items()
         }
 
+    def _read_introspection(self, query, objects):
+        job_config = self._bigquery.QueryJobConfig(
+            query_parameters=[
+                self._bigquery.ArrayQueryParameter("objects", "STRING", list(objects))
+            ]
+        )
+
+        # Rows support access by column name, so they're used as they are
+        return list(self.client.query(query, job_config=job_config).result())
+
     def _get_table_type(self, type):
-        out_key = list()
-        out_value = list()
+        out = dict()
 
         if type["table_type"] == "BASE TABLE":
-            out_key.append("type")
-            out_value.append("table")
+            out["type"] = "table"
         elif type["table_type"] == "VIEW":
-            out_key.append("type")
-            out_value.append("view")
+            out["type"] = "view"
 
         cluster_cols = []
         for c in type["columns"]:
             if c["is_partition"] is True:
-                out_key.append("partition")
-                out_value.append(c["column_name"])
+                out["partition"] = c["column_name"]
             if c["clustering_ordinal_position"] is not None:
                 cluster_cols.append(c["column_name"])
         if cluster_cols:
-            out_key.append("cluster")
-            out_value.append(cluster_cols)
+            # Stored as a frozenset as it's only used for comparisons in create_table
+            out["cluster"] = frozenset(cluster_cols)
 
-        return dict(zip(out_key, out_value))
+        return out
 
     def _py2sqa(self, from_type):
-        python_types = {
-            int: sqltypes.Integer,
-            str: sqltypes.String,
-            float: sqltypes.Float,
-            decimal.Decimal: sqltypes.Numeric,
-            datetime.datetime: sqltypes.TIMESTAMP,
-            bytes: sqltypes.LargeBinary,
-            bool: sqltypes.Boolean,
-            datetime.date: sqltypes.Date,
-            datetime.time: sqltypes.Time,
-            datetime.timedelta: sqltypes.Interval,
-            list: sqltypes.ARRAY,
-            dict: sqltypes.JSON,
-            UUID: sqltypes.String,
-        }
-
-        if from_type not in python_types:
+        try:
+            return self._py2sqa_cache[from_type]
+        except KeyError:
             raise ValueError(f'Type not supported "{from_type}"')
-        else:
-            return python_types[from_type]().compile(dialect=self.engine.dialect)
+
+    def _get_pyarrow(self):
+        if Bigquery._pyarrow is None:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                # Without pyarrow large batches are loaded as NDJSON
+                Bigquery._pyarrow = False
+            else:
+                Bigquery._pyarrow = pyarrow
+
+        return self._pyarrow or None
 
     def _load_data_batch(self, table, data, schema, db):
         full_table_name = f"{self.project if db is None else db}.{self.dataset if schema is None else schema}.{table}"
 
-        from google.cloud import bigquery
+        if (
+            self._parquet_batches
+            and len(data) > self._PARQUET_THRESHOLD
+            and all(d.keys() == data[0].keys() for d in data)
+        ):
+            pa = self._get_pyarrow()
+            try:
+                arrow_table = pa.Table.from_pylist(data)
+            except (pa.ArrowException, TypeError):
+                arrow_table = None
+
+            if arrow_table is not None and not parquet_compatible(arrow_table.schema):
+                arrow_table = None
+
+            if arrow_table is not None:
+                # As with NDJSON, the client needs a file in binary read mode
+                with tempfile.TemporaryFile() as spool:
+                    pa.parquet.write_table(arrow_table, spool, compression="snappy")
+                    job = self.client.load_table_from_file(
+                        spool,
+                        full_table_name,
+                        job_config=self._parquet_load_job_config,
+                        rewind=True,
+                    )
+                self._queue_load_job(job)
+                return job
+
+        # The client only uploads files that report a binary read mode, which
+        # SpooledTemporaryFile doesn't while it's in memory, so the compressed
+        # batch goes to a temporary file on disk
+        with tempfile.TemporaryFile() as spool:
+            with gzip.GzipFile(mode="wb", compresslevel=1, fileobj=spool) as gz:
+                # Encoding the whole batch in one call is faster than one call per
+                # row, at the cost of holding the encoded batch twice in memory
+                # while it's converted. orjson's output is compact, so rows are
+                # separated by "},{" and when that's the only place it appears the
+                # array can be turned into NDJSON by replacing it
+                encoded = orjson.dumps(data) if isinstance(data, list) else None
+                if encoded is not None and encoded.count(b"},{") == len(data) - 1:
+                    ndjson = encoded.replace(b"},{", b"}\n{")
+                    del encoded
+                    # Skip the enclosing brackets without copying the batch again
+                    gz.write(memoryview(ndjson)[1:-1])
+                    gz.write(b"\n")
+                else:
+                    del encoded
+                    for d in data:
+                        gz.write(orjson.dumps(d, option=orjson.OPT_APPEND_NEWLINE))
+
+            if spool.tell() > MAX_GZIP_LOAD_BYTES:
+                raise DBError(
+                    self.name,
+                    self.db_type,
+                    f"Compressed batch for {full_table_name} exceeds BigQuery's 4GB "
+                    "limit. Reduce max_batch_rows.",
+                )
+
+            job = self.client.load_table_from_file(
+                spool,
+                full_table_name,
+                job_config=self._json_load_job_config,
+                rewind=True,
+            )
 
-        job_config = bigquery.LoadJobConfig(
-            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        self._queue_load_job(job)
+        return job
+
+    def _queue_load_job(self, job):
+        # Uploads are complete when a load job is returned by the client, so we
+        # only wait for BigQuery to process them when there's too many of them
+        # running or at the end of load_data
+        self._pending_load_jobs.append(job)
+        if len(self._pending_load_jobs) > MAX_PENDING_LOAD_JOBS:
+            self._pending_load_jobs.pop(0).result()
+
+    def _flush_load_jobs(self):
+        # Jobs stay pending until they succeed so they're cancelled if one fails
+        while len(self._pending_load_jobs) > 0:
+            self._pending_load_jobs[0].result()
+            self._pending_load_jobs.pop(0)
+
+    def _cancel_load_jobs(self):
+        # Later batches would still be appended to the table after a failure, so
+        # pending jobs are cancelled and waited for before the error is raised.
+        # Their own errors, cancellation included, aren't reported
+        pending_load_jobs = self._pending_load_jobs
+        self._pending_load_jobs = list()
+        for job in pending_load_jobs:
+            try:
+                job.cancel()
+            except Exception:
+                pass
+
+        for job in pending_load_jobs:
+            try:
+                job.result()
+            except Exception:
+                pass
+
+    def load_data(
+        self, table, data, db=None, schema=None, batch_size=None, replace=False, **ddl
+    ):
+        # Parquet files carry a schema pyarrow infers from the python types in the
+        # batch, which only matches the table when load_data creates it from those
+        # same types. Loads into existing tables or with ddl columns go as NDJSON
+        self._parquet_batches = (
+            len(ddl.get("columns") or ()) == 0
+            and (replace or not self._table_exists(table, schema))
+            and self._get_pyarrow() is not None
         )
-        client = self.engine.raw_connection()._client
 
-        data_bytes = b"\n".join([orjson.dumps(d) for d in data])
-        job = client.load_table_from_file(
-            io.BytesIO(data_bytes), full_table_name, job_config=job_config
-        )
-        job.result()
+        try:
+            records_loaded = super().load_data(
+                table,
+                data,
+                db=db,
+                schema=schema,
+                batch_size=batch_size,
+                replace=replace,
+                **ddl,
+            )
+            self._flush_load_jobs()
+        except Exception:
+            self._cancel_load_jobs()
+            raise
+        finally:
+            self._parquet_batches = False
+
+        return records_loaded
 
     def move_table(
         self,
@@ -262,11 +498,7 @@ class Bigquery(Database):
     ):
         # ddl = self._format_properties(ddl).value
 
-        full_src_table = (
-            f"{src_db + '.' if src_db is not None else ''}"
-            f"{src_schema + '.' if src_schema is not None else ''}"
-            f"{src_table}"
-        )
+        full_src_table = fully_qualify(src_table, src_schema, src_db)
         select = f"SELECT * FROM {full_src_table}"
         create_or_replace = self.create_table(
             dst_table, dst_schema, dst_db, select=select, replace=True, **ddl
@@ -293,19 +525,19 @@ class Bigquery(Database):
         ):
             db_info = self._requested_objects[db_name][schema_name][table]
             object_type = db_info.get("type")
-            table_exists = bool(object_type == "table")
-            view_exists = bool(object_type == "view")
+            table_exists = object_type == "table"
+            view_exists = object_type == "view"
             partition_column = db_info.get("partition", "")
-            cluster_column = set(db_info.get("cluster", set()))
+            cluster_column = db_info.get("cluster") or frozenset()
         else:
             db_info = dict()
             table_exists = True
             view_exists = True
             partition_column = ""
-            cluster_column = set()
+            cluster_column = frozenset()
 
         des_partitioned = ddl.get("partition") or ""
-        des_clustered = set(ddl.get("cluster") or set())
+        des_clustered = frozenset(ddl.get("cluster") or ())
 
         if des_clustered == cluster_column and des_partitioned == partition_column:
             drop = ""
@@ -314,19 +546,18 @@ class Bigquery(Database):
         else:
             drop = f"DROP VIEW IF EXISTS {full_name};\n"
 
-        template = self._jinja_env.get_template("create_table.sql")
-        query = template.render(
+        query = self._TMPL_CREATE_TABLE.render(
             table_name=table,
             full_name=full_name,
             view_exists=view_exists,
             table_exists=table_exists,
             select=select,
             replace=True,
-            can_replace_table=self.feature("CAN REPLACE TABLE"),
-            needs_cascade=self.feature("NEEDS CASCADE"),
-            cannot_specify_ddl_select=self.feature("CANNOT SPECIFY DDL IN SELECT"),
-            all_columns_have_type=len(
-                [c for c in ddl.get("columns", dict()) if c.get("type") is not None]
+            can_replace_table=self._can_replace_table,
+            needs_cascade=self._needs_cascade,
+            cannot_specify_ddl_select=self._cannot_specify_ddl_select,
+            all_columns_have_type=sum(
+                1 for c in ddl.get("columns") or () if c.get("type") is not None
             ),
             **ddl,
         )
@@ -335,4 +566,42 @@ class Bigquery(Database):
 
 
 def fully_qualify(name, schema=None, db=None):
-    return f"{db+'.' if db is not None else ''}{schema+'.' if schema is not None else ''}{name}"
+    if schema is not None:
+        name = schema + "." + name
+
+    return name if db is None else db + "." + name
+
+
+def parquet_compatible(arrow_schema):
+    """Checks whether a batch with a schema inferred by pyarrow can load as parquet.
+
+    Parquet is only used for tables load_data creates from the python types of the
+    data, so types BigQuery could read as something other than the column
+    create_table made for them are rejected: naive datetimes (read as DATETIME), all
+    None columns, nested values, timedeltas, extension types like UUIDs (stored as
+    strings) and decimals that don't fit NUMERIC.
+
+    Args:
+        arrow_schema (pyarrow.Schema): The schema of the batch as a pyarrow table
+
+    Returns:
+        bool: True if the batch can be loaded as parquet
+    """
+    import pyarrow as pa
+
+    for field in arrow_schema:
+        field_type = field.type
+        if (
+            isinstance(field_type, pa.BaseExtensionType)
+            or pa.types.is_null(field_type)
+            or pa.types.is_nested(field_type)
+            or pa.types.is_duration(field_type)
+            or (pa.types.is_timestamp(field_type) and field_type.tz is None)
+            or (
+                pa.types.is_decimal(field_type)
+                and (field_type.precision > 38 or field_type.scale > 9)
+            )
+        ):
+            return False
+
+    return True
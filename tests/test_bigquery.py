@@ -0,0 +1,315 @@
+import datetime
+import decimal
+import gzip
+import uuid
+
+import pytest
+
+from sayn.database.bigquery import MAX_PENDING_LOAD_JOBS
+from sayn.database.creator import create as create_db
+
+try:
+    from google.cloud.bigquery.client import _check_mode
+except ImportError:
+
+    def _check_mode(file_obj):
+        # Same rule as google.cloud.bigquery.client._check_mode
+        if getattr(file_obj, "mode", None) not in (None, "rb", "r+b", "rb+"):
+            raise ValueError("Cannot upload files opened in text mode")
+
+
+# utils
+
+
+class FakeLoadJob:
+    def __init__(self, source_format, payload, error=None):
+        self.source_format = source_format
+        self.payload = payload
+        self.error = error
+        self.done = False
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def result(self):
+        self.done = True
+        if self.error is not None:
+            raise self.error
+
+
+class FakeClient:
+    """Stands in for google.cloud.bigquery.Client, recording the uploaded files"""
+
+    def __init__(self, job_error=None, fail_upload_at=None):
+        self.jobs = list()
+        self.job_error = job_error
+        self.fail_upload_at = fail_upload_at
+
+    def load_table_from_file(self, file_obj, destination, job_config, rewind=False):
+        if self.fail_upload_at == len(self.jobs):
+            raise ValueError("Upload failed")
+
+        # Refuse the files the real client refuses to upload
+        _check_mode(file_obj)
+        if rewind:
+            file_obj.seek(0)
+        payload = file_obj.read()
+        if payload[:2] == b"\x1f\x8b":
+            payload = gzip.decompress(payload)
+
+        job = FakeLoadJob(job_config, payload, self.job_error)
+        self.jobs.append(job)
+        return job
+
+
+def bigquery_db(client):
+    db = create_db("test", "test", {"type": "bigquery", "project": "project"})
+    # Attributes set by create_engine, which needs a connection to BigQuery
+    db.client = client
+    db.project = "project"
+    db.dataset = "dataset"
+    db._pending_load_jobs = list()
+    db._json_load_job_config = "NEWLINE_DELIMITED_JSON"
+    db._parquet_load_job_config = "PARQUET"
+    db._table_exists = lambda table, schema: True
+
+    return db
+
+
+# tests
+
+
+def test_load_batch_none_then_datetime():
+    client = FakeClient()
+    db = bigquery_db(client)
+
+    db._load_data_batch(
+        "table",
+        [{"ts": None}, {"ts": datetime.datetime(2020, 1, 1)}],
+        None,
+        None,
+    )
+
+    assert len(client.jobs) == 1
+    assert client.jobs[0].source_format == "NEWLINE_DELIMITED_JSON"
+    assert client.jobs[0].payload == b'{"ts":null}\n{"ts":"2020-01-01T00:00:00"}\n'
+
+
+def test_load_batch_ndjson_separators():
+    data = [
+        {"id": 1, "items": [{"x": 1}, {"x": 2}]},
+        {"id": 2, "items": []},
+    ]
+    client = FakeClient()
+    db = bigquery_db(client)
+
+    db._load_data_batch("table", data, None, None)
+
+    assert (
+        client.jobs[0].payload
+        == b'{"id":1,"items":[{"x":1},{"x":2}]}\n{"id":2,"items":[]}\n'
+    )
+
+
+def test_load_batch_ndjson_separator_in_string():
+    data = [{"id": 1, "s": "},{"}, {"id": 2, "s": "a},{b"}, {"id": 3, "s": ""}]
+    client = FakeClient()
+    db = bigquery_db(client)
+
+    db._load_data_batch("table", data, None, None)
+
+    assert (
+        client.jobs[0].payload
+        == b'{"id":1,"s":"},{"}\n{"id":2,"s":"a},{b"}\n{"id":3,"s":""}\n'
+    )
+
+
+def test_load_batch_ndjson_no_separator_in_values():
+    data = [{"id": 1}, {"id": 2}, {}]
+    client = FakeClient()
+    db = bigquery_db(client)
+
+    db._load_data_batch("table", data, None, None)
+
+    assert client.jobs[0].payload == b'{"id":1}\n{"id":2}\n{}\n'
+
+
+def test_parquet_compatible():
+    pa = pytest.importorskip("pyarrow")
+    from sayn.database.bigquery import parquet_compatible
+
+    def compatible(rows):
+        return parquet_compatible(pa.Table.from_pylist(rows).schema)
+
+    assert compatible(
+        [
+            {
+                "i": 1,
+                "s": "a",
+                "f": 1.5,
+                "d": decimal.Decimal("1.5"),
+                "ts": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+                "dt": datetime.date(2020, 1, 1),
+            }
+        ]
+    )
+    # Naive datetimes are read as DATETIME while create_table uses TIMESTAMP
+    assert not compatible([{"ts": datetime.datetime(2020, 1, 1)}])
+    assert not compatible([{"x": None}, {"x": None}])
+    assert not compatible([{"x": {"a": 1}}])
+    assert not compatible([{"x": [1, 2]}])
+    assert not compatible([{"x": datetime.timedelta(days=1)}])
+    assert not compatible([{"x": uuid.uuid4()}])
+    # NUMERIC holds up to 38 digits, 9 of them after the decimal point
+    assert compatible([{"d": decimal.Decimal("1.123456789")}])
+    assert not compatible([{"d": decimal.Decimal("1.1234567890123")}])
+    assert not compatible([{"d": decimal.Decimal("1" * 39)}])
+
+
+def test_load_batch_parquet_fallback():
+    pytest.importorskip("pyarrow")
+    client = FakeClient()
+    db = bigquery_db(client)
+    db._PARQUET_THRESHOLD = 2
+    db._parquet_batches = True
+
+    db._load_data_batch("table", [{"x": i} for i in range(3)], None, None)
+    db._load_data_batch(
+        "table", [{"ts": datetime.datetime(2020, 1, 1)} for i in range(3)], None, None
+    )
+
+    assert [j.source_format for j in client.jobs] == [
+        "PARQUET",
+        "NEWLINE_DELIMITED_JSON",
+    ]
+
+
+def test_load_data_waits_for_jobs():
+    client = FakeClient()
+    db = bigquery_db(client)
+
+    assert db.load_data("table", [{"x": i} for i in range(3)], batch_size=1) == 3
+    assert len(client.jobs) == 3
+    assert all(j.done for j in client.jobs)
+    assert db._pending_load_jobs == []
+
+
+def test_load_data_job_error():
+    client = FakeClient(job_error=ValueError("Load job failed"))
+    db = bigquery_db(client)
+
+    with pytest.raises(ValueError, match="Load job failed"):
+        db.load_data("table", [{"x": i} for i in range(3)], batch_size=1)
+
+    # The first job fails, the others are cancelled and waited for
+    assert all(j.cancelled for j in client.jobs[1:])
+    assert all(j.done for j in client.jobs)
+    assert db._pending_load_jobs == []
+
+
+def test_load_data_upload_error():
+    client = FakeClient(fail_upload_at=2)
+    db = bigquery_db(client)
+
+    with pytest.raises(ValueError, match="Upload failed"):
+        db.load_data("table", [{"x": i} for i in range(4)], batch_size=1)
+
+    assert len(client.jobs) == 2
+    assert all(j.cancelled and j.done for j in client.jobs)
+    assert db._pending_load_jobs == []
+
+
+def test_load_data_pending_jobs_cap_error():
+    data = [{"x": i} for i in range(MAX_PENDING_LOAD_JOBS + 2)]
+
+    # The first job fails when a batch goes over the cap
+    class FailingJobClient(FakeClient):
+        def load_table_from_file(self, *args, **kwargs):
+            job = super().load_table_from_file(*args, **kwargs)
+            if len(self.jobs) == 1:
+                job.error = ValueError("Load job failed")
+            return job
+
+    client = FailingJobClient()
+    db = bigquery_db(client)
+
+    with pytest.raises(ValueError, match="Load job failed"):
+        db.load_data("table", data, batch_size=1)
+
+    assert len(client.jobs) == MAX_PENDING_LOAD_JOBS + 1
+    assert not client.jobs[0].cancelled
+    assert all(j.cancelled and j.done for j in client.jobs[1:])
+    assert db._pending_load_jobs == []
+
+
+def test_load_batch_pending_jobs_cap():
+    client = FakeClient()
+    db = bigquery_db(client)
+
+    for i in range(MAX_PENDING_LOAD_JOBS):
+        db._load_data_batch("table", [{"x": i}], None, None)
+
+    assert not any(j.done for j in client.jobs)
+
+    # Going over the cap waits for the oldest job only
+    db._load_data_batch("table", [{"x": 0}], None, None)
+
+    assert [j.done for j in client.jobs] == [True] + [False] * MAX_PENDING_LOAD_JOBS
+    assert db._pending_load_jobs == client.jobs[1:]
+
+
+def test_load_batch_upload_mode():
+    client = FakeClient()
+    db = bigquery_db(client)
+
+    db._load_data_batch("table", [{"x": 1}], None, None)
+
+    assert client.jobs[0].payload == b'{"x":1}\n'
+
+
+def test_load_batch_parquet_upload_mode():
+    pytest.importorskip("pyarrow")
+    client = FakeClient()
+    db = bigquery_db(client)
+    db._PARQUET_THRESHOLD = 2
+    db._parquet_batches = True
+
+    db._load_data_batch("table", [{"x": i} for i in range(3)], None, None)
+
+    assert client.jobs[0].source_format == "PARQUET"
+
+
+@pytest.mark.parametrize(
+    "table_exists,replace,ddl,source_format",
+    (
+        (False, False, {}, "PARQUET"),
+        (True, True, {}, "PARQUET"),
+        (True, False, {}, "NEWLINE_DELIMITED_JSON"),
+        (
+            False,
+            False,
+            {"columns": [{"name": "x", "type": "NUMERIC"}]},
+            "NEWLINE_DELIMITED_JSON",
+        ),
+    ),
+)
+def test_load_data_parquet_only_for_new_tables(
+    table_exists, replace, ddl, source_format
+):
+    pytest.importorskip("pyarrow")
+    client = FakeClient()
+    db = bigquery_db(client)
+    db._PARQUET_THRESHOLD = 2
+    db._table_exists = lambda table, schema: table_exists
+    # Table creation needs a connection to BigQuery
+    db._py2sqa = lambda from_type: "INT64"
+    db.create_table = lambda table, **kwargs: ""
+    db.execute = lambda query: None
+
+    db.load_data(
+        "table", [{"x": i} for i in range(3)], batch_size=3, replace=replace, **ddl
+    )
+
+    assert [j.source_format for j in client.jobs] == [source_format]
+    assert not db._parquet_batches
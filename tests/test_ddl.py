@@ -1,3 +1,6 @@
+import pytest
+
+from sayn.database.bigquery import DDL as BigqueryDDL
 from sayn.database.creator import create as create_db
 
 
@@ -275,6 +278,42 @@ def test_ddl_cols08(target_db):
     assert result.is_err
 
 
+@pytest.mark.target_dbs(["bigquery"])
+def test_ddl_cluster01(target_db):
+    result = validate_ddl(
+        {
+            "columns": ["col1", "col2"],
+            "table_properties": {"cluster": ["col2"]},
+            "post_hook": [],
+        },
+        target_db=target_db,
+    )
+    assert result.is_ok and result.value["cluster"] == ["col2"]
+
+
+@pytest.mark.target_dbs(["bigquery"])
+def test_ddl_cluster02(target_db):
+    result = validate_ddl(
+        {
+            "columns": ["col1", "col2"],
+            "table_properties": {"cluster": ["col3"]},
+            "post_hook": [],
+        },
+        target_db=target_db,
+    )
+    assert result.is_err
+
+
+def test_bigquery_ddl_cluster01():
+    ddl = BigqueryDDL(columns=["col1", "col2"], properties={"cluster": ["col2"]})
+    assert ddl.get_ddl()["cluster"] == ["col2"]
+
+
+def test_bigquery_ddl_cluster02():
+    with pytest.raises(ValueError):
+        BigqueryDDL(columns=["col1", "col2"], properties={"cluster": ["col3"]})
+
+
 # def test_ddl_idx01():
 #     result = validate_ddl({"indexes": {"idx1": {"columns": ["col1", "col2"]}}})
 #     assert result.is_ok and result.value == {